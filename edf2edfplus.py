@@ -4,17 +4,54 @@ EDF to EDF+ Converter with Excel Events
 MNE Python implementation for merging EDF files with Excel event files and saving as EDF+ format
 """
 
-import mne
+import os
+
+# One BLAS/OpenMP thread per process: batches convert files in parallel worker processes instead
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+
 import pandas as pd
 import numpy as np
-from datetime import datetime
-import os
+from datetime import datetime, timezone
 import sys
+import argparse
 from pathlib import Path
-import glob
 import re
+import mmap
 import struct
+import functools
 import logging
+import logging.handlers
+import queue
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import relative
+
+
+# EDF signal headers: each field is stored for all signals before the next field starts
+SIGNAL_FIELDS = (('label', 16), ('transducer', 80), ('units', 8), ('physical_min', 8),
+                 ('physical_max', 8), ('digital_min', 8), ('digital_max', 8),
+                 ('prefilter', 80), ('samples_per_record', 8), ('reserved', 32))
+
+# patient_number_YYYYMMDD_HHMM part of EDF and Excel filenames
+_EDF_NAME_RE = re.compile(r'(\d+_\d{8}_\d{4})')
+
+# Leading patient number of an EDF filename
+_PATIENT_ID_RE = re.compile(r'(\d+)_')
+
+# Factors from EDF physical dimensions to the SI volts MNE works in
+_UNIT_SCALE = {'V': 1.0, 'mV': 1e-3, 'uV': 1e-6, '\u00b5V': 1e-6, 'nV': 1e-9}
+
+# Label of the EDF+ annotation signal
+EDF_ANNOTATIONS_LABEL = 'EDF Annotations'
+
+# Excel files of each scanned directory, grouped by their patient_number_YYYYMMDD_HHMM pattern
+_excel_index_cache = {}
+
+logger = logging.getLogger(__name__)
+
+# Set in worker processes, whose log records are captured per conversion and replayed by the parent
+_capture_logs = False
 
 
 def setup_logging():
@@ -23,88 +60,82 @@ def setup_logging():
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     log_filename = f"log_edf2edfplus_{timestamp}.log"
     
-    # Configure logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_filename, encoding='utf-8'),
-            logging.StreamHandler(sys.stdout)
-        ]
+    # Console shows plain messages; the file gets timestamps and is written in buffered batches
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter('%(message)s'))
+    
+    file_handler = logging.FileHandler(log_filename, encoding='utf-8', delay=True)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    buffered_file_handler = logging.handlers.MemoryHandler(
+        capacity=1024, flushLevel=logging.WARNING, target=file_handler
     )
     
-    # Suppress MNE warnings in log file but show in console
-    mne.set_log_level('WARNING')
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(console_handler)
+    root_logger.addHandler(buffered_file_handler)
     
     return log_filename
 
 
-def log_print(message):
-    """Print message to both console and log file"""
-    print(message)
-    logging.info(message)
+def parse_times_to_seconds(times):
+    """Parse a Series of time strings (HH:MM:SS.ss) to seconds; unparseable entries become 0"""
+    parts = times.str.split(':', n=3, expand=True).reindex(columns=range(3))
+    hms = parts.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    seconds = hms @ np.array([3600.0, 60.0, 1.0])
+    return np.where(np.isnan(seconds), 0.0, seconds)
 
 
-def parse_time_to_seconds(time_str):
-    """Parse time string (HH:MM:SS.ss) to seconds"""
+def _parse_number(value, cast):
+    """Convert a numeric EDF header field, falling back to zero when blank or malformed"""
     try:
-        parts = time_str.split(':')
-        if len(parts) >= 3:
-            hours = float(parts[0])
-            minutes = float(parts[1])
-            seconds = float(parts[2])
-            return hours * 3600 + minutes * 60 + seconds
-        return 0.0
-    except:
-        return 0.0
-
-
-def parse_edf_time_to_seconds(edf_time_str):
-    """Parse EDF time string (HH.MM.SS) to seconds"""
-    try:
-        # EDF time format: HH.MM.SS (with dots)
-        parts = edf_time_str.split('.')
-        if len(parts) >= 3:
-            hours = float(parts[0])
-            minutes = float(parts[1])
-            seconds = float(parts[2])
-            return hours * 3600 + minutes * 60 + seconds
-        elif len(parts) == 2:
-            # If only HH.MM format, assume seconds as 0
-            hours = float(parts[0])
-            minutes = float(parts[1])
-            seconds = 0.0
-            return hours * 3600 + minutes * 60 + seconds
-        return 0.0
-    except:
-        return 0.0
-
-
-def extract_edf_metadata(edf_file):
-    """Extract metadata from EDF file header"""
+        return cast(value or '0')
+    except ValueError:
+        return cast(0)
+
+
+@functools.lru_cache(maxsize=None)
+def _signal_header_struct(nsignals):
+    """Struct unpacking every field of every signal header (field-major) in one call"""
+    return struct.Struct(''.join(f'{width}s' * nsignals for _, width in SIGNAL_FIELDS))
+
+
+def _parse_edf_header(f, with_signals=False):
+    """Parse the EDF header (and optionally the signal headers) from an open binary file"""
+    header = relative.unpack_edf_header(f.read(relative.EDF_HEADER_STRUCT.size))
+    
+    if with_signals:
+        nsignals = _parse_number(header['nsignals'], int)
+        signal_struct = _signal_header_struct(nsignals)
+        values = signal_struct.unpack_from(f.read(signal_struct.size))
+        header['signals'] = [{} for _ in range(nsignals)]
+        for k, (name, _) in enumerate(SIGNAL_FIELDS):
+            for i, signal_info in enumerate(header['signals']):
+                signal_info[name] = values[k * nsignals + i].decode('latin-1').strip()
+    
+    return header
+
+
+def edf_header_duration(edf_file):
+    """Recording duration (records x record duration) from the EDF header, without reading samples"""
+    with open(edf_file, 'rb') as f:
+        header = _parse_edf_header(f)
+    return _parse_number(header['records'], int) * _parse_number(header['duration'], float)
+
+
+def edf_file_complete(edf_file):
+    """Check that an EDF file holds every data record its header declares"""
     try:
         with open(edf_file, 'rb') as f:
-            # Read EDF header (256 bytes)
-            header_bytes = f.read(256)
-            header_str = header_bytes.decode('ascii', errors='ignore')
-            
-            # Parse header information
-            metadata = {}
-            metadata['version'] = header_str[0:8].strip()
-            metadata['patient_id'] = header_str[8:88].strip()
-            metadata['recording_id'] = header_str[88:168].strip()
-            metadata['start_date'] = header_str[168:176].strip()  # DD.MM.YY format
-            metadata['start_time'] = header_str[176:184].strip()  # HH.MM.SS format
-            metadata['header_bytes'] = header_str[184:192].strip()
-            metadata['reserved'] = header_str[192:236].strip()
-            metadata['records'] = header_str[236:244].strip()
-            metadata['duration'] = header_str[244:252].strip()
-            metadata['nsignals'] = header_str[252:256].strip()
-            
-            return metadata
-    except Exception as e:
-        log_print(f"Error reading EDF metadata: {e}")
-        return None
+            header = _parse_edf_header(f, with_signals=True)
+    except (OSError, struct.error):
+        return False
+    nsignals = _parse_number(header['nsignals'], int)
+    n_records = _parse_number(header['records'], int)
+    if nsignals <= 0 or n_records < 0 or _parse_number(header['header_bytes'], int) != 256 * (nsignals + 1):
+        return False
+    record_bytes = 2 * sum(_parse_number(signal['samples_per_record'], int) for signal in header['signals'])
+    return os.path.getsize(edf_file) >= 256 * (nsignals + 1) + n_records * record_bytes
 
 
 def convert_edf_date_time(date_str, time_str):
@@ -121,15 +152,16 @@ def convert_edf_date_time(date_str, time_str):
         
         return f"{date_formatted}_{time_formatted}"
     except Exception as e:
-        log_print(f"Error converting date/time: {e}")
+        logger.error(f"Error converting date/time: {e}")
         return None
 
 
-def generate_correct_filename(edf_file):
-    """Generate correct filename based on EDF metadata"""
+def generate_correct_filename(edf_file, metadata=None):
+    """Generate correct filename based on EDF metadata (parsed from the file unless given)"""
     try:
         # Extract metadata
-        metadata = extract_edf_metadata(edf_file)
+        if metadata is None:
+            metadata = relative.extract_edf_metadata(edf_file)
         if not metadata:
             return None
         
@@ -137,12 +169,11 @@ def generate_correct_filename(edf_file):
         patient_id = metadata['patient_id'].strip()
         if not patient_id or patient_id == "No Database Record":
             # Extract patient ID from filename
-            import re
-            match = re.search(r'(\d+)_', os.path.basename(edf_file))
+            match = _PATIENT_ID_RE.search(os.path.basename(edf_file))
             if match:
                 patient_id = match.group(1)
             else:
-                log_print(f"Could not extract patient ID from filename: {edf_file}")
+                logger.info(f"Could not extract patient ID from filename: {edf_file}")
                 return None
         
         # Convert EDF date/time to YYYYMMDD_HHMM format
@@ -153,136 +184,99 @@ def generate_correct_filename(edf_file):
         # Generate new filename
         new_filename = f"{patient_id}_{date_time_str}.edf"
         
-        log_print(f"  Original filename: {os.path.basename(edf_file)}")
-        log_print(f"  EDF metadata - Date: {metadata['start_date']}, Time: {metadata['start_time']}")
-        log_print(f"  Generated filename: {new_filename}")
+        logger.info(f"  Original filename: {os.path.basename(edf_file)}")
+        logger.info(f"  EDF metadata - Date: {metadata['start_date']}, Time: {metadata['start_time']}")
+        logger.info(f"  Generated filename: {new_filename}")
         
         return new_filename
         
     except Exception as e:
-        log_print(f"Error generating filename: {e}")
+        logger.error(f"Error generating filename: {e}")
         return None
 
 
 def read_edf_file_direct(filename):
     """Read EDF file directly (like MATLAB)"""
-    with open(filename, 'rb') as f:
-        # Read EDF header (256 bytes)
-        header_bytes = f.read(256)
-        header_str = header_bytes.decode('ascii', errors='ignore')
-        
-        # Parse header information
-        header = {}
-        try:
-            header['version'] = float(header_str[0:8].strip() or '0')
-        except:
-            header['version'] = 0.0
-        header['patient_id'] = header_str[8:88].strip()
-        header['recording_id'] = header_str[88:168].strip()
-        header['start_date'] = header_str[168:176].strip()
-        header['start_time'] = header_str[176:184].strip()
-        try:
-            header['header_bytes'] = int(header_str[184:192].strip() or '0')
-        except:
-            header['header_bytes'] = 0
-        header['reserved'] = header_str[192:236].strip()
-        try:
-            header['records'] = int(header_str[236:244].strip() or '0')
-        except:
-            header['records'] = 0
-        try:
-            header['duration'] = float(header_str[244:252].strip() or '0')
-        except:
-            header['duration'] = 0.0
-        try:
-            header['nsignals'] = int(header_str[252:256].strip() or '0')
-        except:
-            header['nsignals'] = 0
-        
-        # Read signal headers (nsignals * 256 bytes)
-        signal_header_bytes = f.read(header['nsignals'] * 256)
-        signal_header_str = signal_header_bytes.decode('ascii', errors='ignore')
-        
-        # Parse each signal's information
-        header['signals'] = []
-        for i in range(header['nsignals']):
-            start_idx = i * 256
-            end_idx = (i + 1) * 256
-            signal_str = signal_header_str[start_idx:end_idx]
-            
-            signal_info = {}
-            signal_info['label'] = signal_str[0:16].strip()
-            signal_info['transducer'] = signal_str[16:32].strip()
-            signal_info['units'] = signal_str[32:40].strip()
-            try:
-                signal_info['physical_min'] = float(signal_str[40:48].strip() or '0')
-            except:
-                signal_info['physical_min'] = 0.0
-            try:
-                signal_info['physical_max'] = float(signal_str[48:56].strip() or '0')
-            except:
-                signal_info['physical_max'] = 0.0
-            try:
-                signal_info['digital_min'] = int(signal_str[56:64].strip() or '0')
-            except:
-                signal_info['digital_min'] = 0
-            try:
-                signal_info['digital_max'] = int(signal_str[64:72].strip() or '0')
-            except:
-                signal_info['digital_max'] = 0
-            signal_info['prefilter'] = signal_str[72:80].strip()
-            try:
-                signal_info['samples_per_record'] = int(signal_str[80:88].strip() or '0')
-            except:
-                signal_info['samples_per_record'] = 0
-            signal_info['reserved'] = signal_str[88:256].strip()
-            
-            header['signals'].append(signal_info)
-        
-        # Read data
-        data = []
-        
-        # Calculate total samples for each signal (each signal can have different sample counts)
-        total_samples_per_signal = []
-        for sig in range(header['nsignals']):
-            samples_per_record = header['signals'][sig]['samples_per_record']
-            total_samples = header['records'] * samples_per_record
-            total_samples_per_signal.append(total_samples)
-        
-        log_print(f"  EDF header info:")
-        log_print(f"    Records: {header['records']}")
-        log_print(f"    Duration: {header['duration']}")
-        log_print(f"    Signals: {header['nsignals']}")
-        log_print(f"    Samples per record for each signal: {[s['samples_per_record'] for s in header['signals'][:5]]}")
-        
-        # Pre-allocate data array (use maximum samples for all signals)
-        max_samples = max(total_samples_per_signal) if total_samples_per_signal else 0
+    # A 64 KiB buffer serves the general and signal headers from a single read system call
+    with open(filename, 'rb', buffering=65536) as f:
+        # Parse the general and signal headers in one pass
+        header = _parse_edf_header(f, with_signals=True)
+        header['version'] = _parse_number(header['version'], float)
+        header['header_bytes'] = _parse_number(header['header_bytes'], int)
+        header['records'] = _parse_number(header['records'], int)
+        header['duration'] = _parse_number(header['duration'], float)
+        header['nsignals'] = len(header['signals'])
+        for signal_info in header['signals']:
+            signal_info['physical_min'] = _parse_number(signal_info['physical_min'], float)
+            signal_info['physical_max'] = _parse_number(signal_info['physical_max'], float)
+            signal_info['digital_min'] = _parse_number(signal_info['digital_min'], int)
+            signal_info['digital_max'] = _parse_number(signal_info['digital_max'], int)
+            signal_info['samples_per_record'] = _parse_number(signal_info['samples_per_record'], int)
+        
+        samples_per_record = np.array([s['samples_per_record'] for s in header['signals']], dtype=np.int32)
+        
+        logger.info(f"  EDF header info:")
+        logger.info(f"    Records: {header['records']}")
+        logger.info(f"    Duration: {header['duration']}")
+        logger.info(f"    Signals: {header['nsignals']}")
+        logger.info(f"    Samples per record for each signal: {[s['samples_per_record'] for s in header['signals'][:5]]}")
+        
+        # Only complete records present in the file are read (a truncated recording yields fewer samples)
+        rec_samples = int(samples_per_record.sum())
+        header_end = f.tell()
+        file_size = os.fstat(f.fileno()).st_size
+        n_records = min(header['records'], max(file_size - header_end, 0) // (rec_samples * 2)) if rec_samples > 0 else 0
+        if n_records < header['records'] and rec_samples > 0:
+            logger.warning(f"  Warning: Only {n_records} of {header['records']} data records present in file")
+        
+        # Pre-allocate data array (each signal can have different sample counts; use the maximum for all)
+        max_samples = max(n_records, 0) * int(samples_per_record.max()) if header['nsignals'] else 0
         data = np.zeros((header['nsignals'], max_samples), dtype=np.int16)
-        
-        # Read data for each record
-        for rec in range(header['records']):
-            for sig in range(header['nsignals']):
-                samples = header['signals'][sig]['samples_per_record']
-                if samples > 0:
-                    signal_data = struct.unpack('<' + 'h' * samples, f.read(samples * 2))
-                    if len(signal_data) == samples:
-                        start_idx = rec * samples
-                        end_idx = (rec + 1) * samples
-                        if end_idx <= max_samples:
-                            data[sig, start_idx:end_idx] = signal_data
-                        else:
-                            log_print(f"  Warning: Signal {sig} data exceeds allocated space")
-                    else:
-                        log_print(f"  Warning: Sample count mismatch in signal {sig}, record {rec}")
-                else:
-                    # Skip reading for signals with 0 samples per record
-                    pass
+        if n_records <= 0:
+            return header, data
+        
+        # Map the data section once; each record holds every signal's samples back to back
+        offsets = np.concatenate(([0], np.cumsum(samples_per_record)[:-1]))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Let the kernel read ahead the whole data section in large asynchronous requests
+            if hasattr(mm, 'madvise'):
+                for advice in ('MADV_SEQUENTIAL', 'MADV_WILLNEED'):
+                    if hasattr(mmap, advice):
+                        mm.madvise(getattr(mmap, advice))
+            records = np.frombuffer(mm, dtype='<i2', count=n_records * rec_samples, offset=header_end).reshape(n_records, rec_samples)
+            if np.all(samples_per_record == samples_per_record[0]):
+                # Uniform signals: demultiplex every record with one strided copy out of the mapping
+                samples = int(samples_per_record[0])
+                out = data[:, :n_records * samples].reshape(header['nsignals'], n_records, samples)
+                out[...] = records.reshape(n_records, header['nsignals'], samples).transpose(1, 0, 2)
+            else:
+                # Heterogeneous signals: gather each signal's columns across all records at once
+                for sig in range(header['nsignals']):
+                    samples = int(samples_per_record[sig])
+                    if samples > 0:
+                        off = int(offsets[sig])
+                        data[sig, :n_records * samples] = records[:, off:off + samples].reshape(-1)
+            # Release the buffer view before the mapping is closed
+            del records
         
         return header, data
 
 
+def get_edf_start_datetime(edf_header):
+    """Get the recording start (UTC) from EDF header date/time, or None if malformed"""
+    try:
+        day, month, year = (int(part) for part in edf_header['start_date'].split('.'))
+        hour, minute, second = (int(part) for part in edf_header['start_time'].split('.'))
+        full_year = 2000 + year if year < 50 else 1900 + year
+        return datetime(full_year, month, day, hour, minute, second, tzinfo=timezone.utc)
+    except (KeyError, ValueError):
+        return None
+
+
 def create_mne_raw_from_edf_data(edf_header, edf_data):
     """Create MNE Raw object from direct EDF data"""
+    import mne
+    
     # Calculate sampling rate
     sampling_rate = edf_header['signals'][0]['samples_per_record'] / edf_header['duration']
     
@@ -296,22 +290,145 @@ def create_mne_raw_from_edf_data(edf_header, edf_data):
         ch_types=['eeg'] * len(ch_names)
     )
     
-    # Convert int16 to float64 and apply scaling
-    data_float = edf_data.astype(np.float64)
-    
-    # Apply physical scaling
-    for i, signal in enumerate(edf_header['signals']):
-        if signal['physical_max'] != signal['physical_min']:
-            scale = (signal['physical_max'] - signal['physical_min']) / (signal['digital_max'] - signal['digital_min'])
-            offset = signal['physical_min'] - scale * signal['digital_min']
-            data_float[i, :] = data_float[i, :] * scale + offset
+    # Per-signal physical scaling (signals without a valid range are left unscaled)
+    signals = edf_header['signals']
+    pmin = np.fromiter((s['physical_min'] for s in signals), dtype=np.float64, count=len(signals))
+    pmax = np.fromiter((s['physical_max'] for s in signals), dtype=np.float64, count=len(signals))
+    dmin = np.fromiter((s['digital_min'] for s in signals), dtype=np.float64, count=len(signals))
+    dmax = np.fromiter((s['digital_max'] for s in signals), dtype=np.float64, count=len(signals))
+    valid = (pmax != pmin) & (dmax != dmin)
+    scale = np.where(valid, (pmax - pmin) / np.where(valid, dmax - dmin, 1.0), 1.0)
+    offset = np.where(valid, pmin - scale * dmin, 0.0)
     
+    # MNE expects volts; fold the unit conversion into the same multiply-add
+    units = np.fromiter((_UNIT_SCALE.get(s['units'], 1.0) for s in signals), dtype=np.float64, count=len(signals))
+    scale *= units
+    offset *= units
+
+    # Convert int16 to float64 (the dtype RawArray stores, so it is not copied again) and scale,
+    # multiplying straight from int16 into the output buffer: no separate cast pass over the data
+    data_float = np.empty(edf_data.shape, dtype=np.float64)
+    np.multiply(edf_data, scale[:, None], out=data_float)
+    np.add(data_float, offset[:, None], out=data_float)
+
     # Create Raw object
     raw = mne.io.RawArray(data_float, info, verbose=False)
+    raw.set_meas_date(get_edf_start_datetime(edf_header))
     
     return raw
 
 
+def _format_edf_number(value, width=8):
+    """Format a number as compactly as possible for a fixed-width EDF header field"""
+    if float(value).is_integer():
+        text = str(int(value))
+    else:
+        text = repr(float(value))
+    precision = width
+    while len(text) > width and precision > 1:
+        precision -= 1
+        text = f"{value:.{precision}g}"
+    return text
+
+
+def _format_tal_time(seconds):
+    """Format an onset/duration for a TAL: signed, without trailing zeros"""
+    return f"{seconds:+.6f}".rstrip('0').rstrip('.')
+
+
+def _write_edfplus(path, header, int16_data, annotations):
+    """Write an EDF+C file from the original digital samples plus an EDF Annotations signal"""
+    signals = header['signals']
+    nsignals = len(signals)
+    n_records = max(header['records'], 0)
+    duration = header['duration']
+    
+    # TALs of each data record: the timekeeping TAL, then the annotations starting in that record
+    tals = [[f"{_format_tal_time(r * duration)}\x14\x14\x00".encode('utf-8')] for r in range(n_records)]
+    if n_records:
+        for onset, event_duration, description in zip(annotations.onset, annotations.duration, annotations.description):
+            record = min(max(int(onset // duration), 0), n_records - 1) if duration > 0 else 0
+            tal = _format_tal_time(onset)
+            if event_duration > 0:
+                tal += f"\x15{_format_tal_time(event_duration)[1:]}"
+            tals[record].append(f"{tal}\x14{description}\x14\x00".encode('utf-8'))
+    tals = [b''.join(record_tals) for record_tals in tals]
+    annotation_samples = max((len(tal) + 1) // 2 for tal in tals) if tals else 1
+    
+    samples_per_record = [s['samples_per_record'] for s in signals] + [annotation_samples]
+    offsets = np.concatenate(([0], np.cumsum(samples_per_record)[:-1]))
+    record_samples = int(sum(samples_per_record))
+    
+    # General header, then the signal headers field by field (annotation signal last)
+    fields = {
+        'label': [s['label'] for s in signals] + [EDF_ANNOTATIONS_LABEL],
+        'transducer': [s['transducer'] for s in signals] + [''],
+        'units': [s['units'] for s in signals] + [''],
+        'physical_min': [_format_edf_number(s['physical_min']) for s in signals] + ['-1'],
+        'physical_max': [_format_edf_number(s['physical_max']) for s in signals] + ['1'],
+        'digital_min': [str(s['digital_min']) for s in signals] + ['-32768'],
+        'digital_max': [str(s['digital_max']) for s in signals] + ['32767'],
+        'prefilter': [s['prefilter'] for s in signals] + [''],
+        'samples_per_record': [str(n) for n in samples_per_record],
+        'reserved': [''] * (nsignals + 1),
+    }
+    general = {
+        'version': '0',
+        'patient_id': header['patient_id'],
+        'recording_id': header['recording_id'],
+        'start_date': header['start_date'],
+        'start_time': header['start_time'],
+        'header_bytes': str(256 * (nsignals + 2)),
+        'reserved': 'EDF+C',
+        'records': str(n_records),
+        'duration': _format_edf_number(duration),
+        'nsignals': str(nsignals + 1),
+    }
+    general_widths = (8, 80, 80, 8, 8, 8, 44, 8, 8, 4)
+    header_bytes = relative.EDF_HEADER_STRUCT.pack(*(general[name].encode('latin-1', errors='replace').ljust(width)[:width]
+                                                     for name, width in zip(relative.EDF_HEADER_FIELDS, general_widths)))
+    header_bytes += b''.join(value.encode('latin-1', errors='replace').ljust(width)[:width]
+                             for name, width in SIGNAL_FIELDS for value in fields[name])
+    
+    # Assemble all records at once: each signal's digital samples, padded past the recorded
+    # data with the digital value closest to physical zero, followed by the record's TALs
+    records = np.empty((n_records, record_samples), dtype='<i2')
+    max_samples = max((s['samples_per_record'] for s in signals), default=0)
+    available = min(int16_data.shape[1] // max_samples if max_samples else 0, n_records)
+    for sig, signal_info in enumerate(signals):
+        samples = signal_info['samples_per_record']
+        off = int(offsets[sig])
+        records[:available, off:off + samples] = int16_data[sig, :available * samples].reshape(available, samples)
+        pmin, pmax = signal_info['physical_min'], signal_info['physical_max']
+        dmin, dmax = signal_info['digital_min'], signal_info['digital_max']
+        zero = round(dmin - pmin * (dmax - dmin) / (pmax - pmin)) if pmax != pmin else 0
+        records[available:, off:off + samples] = min(max(zero, dmin, -32768), dmax, 32767)
+    annotation_bytes = records[:, int(offsets[-1]):].view(np.uint8)
+    annotation_bytes[...] = 0
+    for r, tal in enumerate(tals):
+        annotation_bytes[r, :len(tal)] = np.frombuffer(tal, dtype=np.uint8)
+    
+    with open(path, 'wb', buffering=65536) as f:
+        f.write(header_bytes)
+        # Write the record array straight from its buffer (tobytes() would copy it first)
+        f.write(memoryview(records).cast('B'))
+
+
+def get_excel_index(directory):
+    """Group a directory's Excel files by filename pattern, scanning each directory only once"""
+    index = _excel_index_cache.get(directory)
+    if index is None:
+        index = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.xlsx') and not entry.name.startswith('.') and entry.is_file():
+                    match = _EDF_NAME_RE.search(entry.name)
+                    if match:
+                        index.setdefault(match.group(1), []).append(os.path.join(directory, entry.name))
+        _excel_index_cache[directory] = index
+    return index
+
+
 def find_matching_excel_files(edf_file):
     """Find EDF file and matching Excel files"""
     edf_path = Path(edf_file)
@@ -320,52 +437,47 @@ def find_matching_excel_files(edf_file):
     # Extract patient_number_YYYYMMDD_HHMM pattern from EDF filename
     # Example: 5774131_20130701_2359 -> 5774131_20130701_2359
     # Patient number is one or more digits
-    pattern = r'(\d+_\d{8}_\d{4})'
-    match = re.search(pattern, edf_name)
+    match = _EDF_NAME_RE.search(edf_name)
     
     if not match:
-        log_print(f"  Cannot find patient_number_date_time pattern in EDF filename: {edf_name}")
+        logger.info(f"  Cannot find patient_number_date_time pattern in EDF filename: {edf_name}")
         return []
     
     full_pattern = match.group(1)  # patient_number_YYYYMMDD_HHMM
     
-    log_print(f"  Matching pattern: {full_pattern}")
-    
-    # Find matching Excel files in the same directory
-    edf_dir = edf_path.parent
-    excel_files = []
+    logger.info(f"  Matching pattern: {full_pattern}")
     
-    # Find all Excel files that contain the pattern (regardless of additional text)
-    pattern = f"{edf_dir}/*{full_pattern}*.xlsx"
-    matching_files = glob.glob(pattern)
+    # Look up Excel files in the same directory that carry the same pattern
+    matching_files = get_excel_index(edf_path.parent).get(full_pattern, [])
+    excel_files = list(matching_files)
     
     if matching_files:
-        excel_files.extend(matching_files)
-        log_print(f"  Found {len(matching_files)} Excel files:")
+        logger.info(f"  Found {len(matching_files)} Excel files:")
         for file in matching_files:
-            log_print(f"    - {Path(file).name}")
+            logger.info(f"    - {Path(file).name}")
     else:
-        log_print(f"  No Excel files found with pattern: {full_pattern}")
+        logger.info(f"  No Excel files found with pattern: {full_pattern}")
     
     return excel_files
 
 
-def get_reference_time_from_edf_metadata(edf_file):
-    """Get reference time from EDF metadata start time"""
+def get_reference_time_from_edf_metadata(edf_file, metadata=None):
+    """Get reference time from EDF metadata start time (parsed from the file unless given)"""
     try:
-        metadata = extract_edf_metadata(edf_file)
+        if metadata is None:
+            metadata = relative.extract_edf_metadata(edf_file)
         if not metadata:
             return None
         
         start_time_str = metadata['start_time']
-        reference_seconds = parse_edf_time_to_seconds(start_time_str)
+        reference_seconds = relative.parse_edf_time_to_seconds(start_time_str)
         
-        log_print(f"  EDF start time: {start_time_str}")
-        log_print(f"  Reference time (EDF start): {reference_seconds:.2f}s")
+        logger.info(f"  EDF start time: {start_time_str}")
+        logger.info(f"  Reference time (EDF start): {reference_seconds:.2f}s")
         return reference_seconds
         
     except Exception as e:
-        log_print(f"Error getting EDF reference time: {e}")
+        logger.error(f"Error getting EDF reference time: {e}")
         return None
 
 
@@ -377,79 +489,63 @@ def get_reference_time_from_events(all_events):
     # Find the earliest event time
     earliest_time = min(event['time_seconds'] for event in all_events)
     
-    log_print(f"  Reference time (earliest event): {earliest_time:.2f}s")
+    logger.info(f"  Reference time (earliest event): {earliest_time:.2f}s")
     return earliest_time
 
 
 def load_excel_events(excel_file, reference_time=None):
     """Load events from Excel file with relative time calculation"""
     try:
-        # Try different methods to read Excel
-        try:
-            df = pd.read_excel(excel_file, header=None)
-        except:
-            df = pd.read_excel(excel_file, engine='openpyxl', header=None)
+        df = pd.read_excel(excel_file, engine='openpyxl', header=None)
         
         # Remove first empty row
         if len(df) > 0 and df.iloc[0].isna().all():
             df = df.iloc[1:].reset_index(drop=True)
         
-        log_print(f"Excel data shape: {df.shape}")
-        log_print(f"All data:")
-        for i in range(len(df)):
-            log_print(f"  Row {i}: {df.iloc[i].tolist()}")
+        logger.info(f"Excel data shape: {df.shape}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"All data:")
+            for i in range(len(df)):
+                logger.debug(f"  Row {i}: {df.iloc[i].tolist()}")
         
-        # Extract events (time in column 2, event type in column 3)
-        events = []
-        for i in range(len(df)):
-            time_str = str(df.iloc[i, 2]).strip()  # Column C (index 2)
-            event_type = str(df.iloc[i, 3]).strip()  # Column D (index 3)
-            
-            log_print(f"  Processing row {i}: time='{time_str}', event='{event_type}'")
-            
-            # Check conditions
-            has_time = ':' in time_str
-            valid_event = event_type not in ['nan', 'None', ''] and str(event_type).strip() != ''
-            
-            if not has_time:
-                log_print(f"    -> Skipped: No time format (:)")
-            elif not valid_event:
-                log_print(f"    -> Skipped: Invalid event type")
-            
-            if has_time and valid_event:
-                time_seconds = parse_time_to_seconds(time_str)
-                
-                # Always use EDF reference time for calculation, ignore Excel relative time
-                if reference_time is not None:
-                    relative_time = time_seconds - reference_time
-                    events.append({
-                        'time': time_str,
-                        'time_seconds': time_seconds,
-                        'relative_time': relative_time,
-                        'event_type': event_type,
-                        'row_index': i  # Store original row index for status update
-                    })
-                    log_print(f"    -> Added event: {event_type} at {time_str} (absolute: {time_seconds:.2f}s, relative: {relative_time:.2f}s) [EDF-based]")
-                else:
-                    events.append({
-                        'time': time_str,
-                        'time_seconds': time_seconds,
-                        'event_type': event_type,
-                        'row_index': i  # Store original row index for status update
-                    })
-                    log_print(f"    -> Added event: {event_type} at {time_str} ({time_seconds:.2f}s)")
+        # Extract events (time in column C, event type in column D), filtering all rows at once
+        times = df[2].map(str).str.strip()
+        event_types = df[3].map(str).str.strip()
+        has_time = times.str.contains(':', regex=False)
+        valid_event = ~event_types.isin(['nan', 'None', ''])
+        valid = (has_time & valid_event).to_numpy()
         
-        log_print(f"Loaded {len(events)} events")
+        logger.info(f"  Valid event rows: {int(valid.sum())} of {len(df)}")
+        logger.info(f"  Skipped: {int((~has_time).sum())} without time format (:), "
+                  f"{int((has_time & ~valid_event).sum())} with invalid event type")
+        
+        rows = np.flatnonzero(valid)
+        time_seconds = parse_times_to_seconds(times.iloc[rows])
+        
+        events = []
+        for i, seconds in zip(rows, time_seconds.tolist()):
+            event = {
+                'time': times.iat[i],
+                'time_seconds': seconds,
+                'event_type': event_types.iat[i],
+                'row_index': int(i)  # Store original row index for status update
+            }
+            # Always use EDF reference time for calculation, ignore Excel relative time
+            if reference_time is not None:
+                event['relative_time'] = seconds - reference_time
+            events.append(event)
+        
+        logger.info(f"Loaded {len(events)} events")
         for i, event in enumerate(events[:5]):  # Show first 5 events
             if 'relative_time' in event:
-                log_print(f"  Event {i+1}: {event['event_type']} at {event['time']} (absolute: {event['time_seconds']:.2f}s, relative: {event['relative_time']:.2f}s)")
+                logger.info(f"  Event {i+1}: {event['event_type']} at {event['time']} (absolute: {event['time_seconds']:.2f}s, relative: {event['relative_time']:.2f}s)")
             else:
-                log_print(f"  Event {i+1}: {event['event_type']} at {event['time']} ({event['time_seconds']:.2f}s)")
+                logger.info(f"  Event {i+1}: {event['event_type']} at {event['time']} ({event['time_seconds']:.2f}s)")
         
         return events
         
     except Exception as e:
-        log_print(f"Error loading Excel file: {e}")
+        logger.error(f"Error loading Excel file: {e}")
         return []
 
 
@@ -462,13 +558,7 @@ def update_excel_event_status(excel_file, event_status_info):
         wb = openpyxl.load_workbook(excel_file)
         ws = wb.active
         
-        # Ensure we have enough columns (add column F for status if needed)
-        max_col = ws.max_column
-        if max_col < 6:  # Need column F (index 6)
-            for row in range(1, ws.max_row + 1):
-                ws.cell(row=row, column=6, value="")
-        
-        # Update status for each event
+        # Update status for each event (column F is created on first write)
         for event_info in event_status_info:
             row_idx = event_info['row_index'] + 1  # Excel is 1-indexed
             status = event_info['status']
@@ -476,199 +566,215 @@ def update_excel_event_status(excel_file, event_status_info):
         
         # Save the file
         wb.save(excel_file)
-        log_print(f"  Updated Excel file with event status: {excel_file}")
+        logger.info(f"  Updated Excel file with event status: {excel_file}")
         
     except Exception as e:
-        log_print(f"  Error updating Excel file status: {e}")
+        logger.error(f"  Error updating Excel file status: {e}")
+
 
+def flush_excel_event_status(pending_updates):
+    """Write all queued event status updates, loading and saving each Excel file once"""
+    for excel_file, status_updates in pending_updates.items():
+        update_excel_event_status(excel_file, status_updates)
+    pending_updates.clear()
 
-def convert_edf_to_edfplus(edf_file, output_file=None):
+
+def convert_edf_to_edfplus(edf_file, output_file=None, pending_updates=None, direct_read=False):
     """Convert EDF file with Excel events to EDF+ format"""
     
-    log_print(f"=== EDF to EDF+ Conversion ===")
-    log_print(f"EDF file: {edf_file}")
+    logger.info(f"=== EDF to EDF+ Conversion ===")
+    logger.info(f"EDF file: {edf_file}")
     
     try:
         # 1. Find matching Excel files
-        log_print("\n1. Finding matching Excel files...")
+        logger.info("\n1. Finding matching Excel files...")
         excel_files = find_matching_excel_files(edf_file)
         
         if not excel_files:
-            log_print("  No matching Excel files found")
+            logger.info("  No matching Excel files found")
             return False
         
         # 2. Load EDF file with improved duration handling
-        log_print("\n2. Loading EDF file...")
-        
-        # Read EDF header to get correct duration
-        with open(edf_file, 'rb') as f:
-            header = f.read(256)
-            n_records = int(header[236:244].decode('ascii').strip())
-            record_duration = float(header[244:252].decode('ascii').strip())
-            header_duration = n_records * record_duration
+        logger.info("\n2. Loading EDF file...")
         
-        log_print(f"  EDF header duration: {header_duration:.2f} seconds")
-        log_print(f"  EDF records: {n_records}, record duration: {record_duration:.2f}s")
+        # MNE is only imported once a file is actually converted; keep its own messages to warnings
+        import mne
+        mne.set_log_level('WARNING')
         
-        # Load with MNE but with better parameters
-        try:
-            raw = mne.io.read_raw_edf(edf_file, preload=True, verbose=False, stim_channel=None)
-        except:
-            # Fallback: try with different parameters
-            raw = mne.io.read_raw_edf(edf_file, preload=True, verbose=False)
+        # Parse the EDF header once; it is reused for the duration, reference time and filename
+        metadata = relative.extract_edf_metadata(edf_file)
+        if not metadata:
+            logger.info("  Could not read EDF header")
+            return False
+        n_records = int(metadata['records'])
+        record_duration = float(metadata['duration'])
+        header_duration = n_records * record_duration
+        
+        logger.info(f"  EDF header duration: {header_duration:.2f} seconds")
+        logger.info(f"  EDF records: {n_records}, record duration: {record_duration:.2f}s")
+        
+        if direct_read:
+            # Read samples with the built-in reader instead of MNE (never both), skipping EDF+ annotation signals
+            edf_header, edf_data = read_edf_file_direct(edf_file)
+            keep = [i for i, signal in enumerate(edf_header['signals']) if signal['label'] != EDF_ANNOTATIONS_LABEL]
+            edf_header['signals'] = [edf_header['signals'][i] for i in keep]
+            edf_header['nsignals'] = len(keep)
+            edf_data = edf_data[keep]
+            raw = create_mne_raw_from_edf_data(edf_header, edf_data)
+        else:
+            # Load with MNE but with better parameters
+            try:
+                raw = mne.io.read_raw_edf(edf_file, preload=True, verbose=False, stim_channel=None)
+            except:
+                # Fallback: try with different parameters
+                raw = mne.io.read_raw_edf(edf_file, preload=True, verbose=False)
         
         mne_duration = raw.times[-1]
-        log_print(f"  MNE reported duration: {mne_duration:.2f} seconds")
+        logger.info(f"  MNE reported duration: {mne_duration:.2f} seconds")
         
         # Check for duration mismatch and fix it
         duration_diff = abs(mne_duration - header_duration)
-        log_print(f"  Duration difference: {duration_diff:.2f} seconds")
+        logger.info(f"  Duration difference: {duration_diff:.2f} seconds")
         
         # Store original duration for event filtering
         original_duration = mne_duration
         zero_padding_start = None
         
         if duration_diff > 0.01:  # Very sensitive threshold (0.01 seconds)
-            log_print(f"  Duration mismatch detected! Fixing data...")
+            logger.info(f"  Duration mismatch detected! Fixing data...")
             target_samples = int(header_duration * raw.info['sfreq'])
-            current_samples = raw.get_data().shape[1]
+            current_samples = raw.n_times
             
-            log_print(f"  Target samples: {target_samples}, Current samples: {current_samples}")
+            logger.info(f"  Target samples: {target_samples}, Current samples: {current_samples}")
             
+            # Work on the preloaded buffer directly: get_data() would copy the whole recording first
             if target_samples > current_samples:
                 # Pad with zeros instead of repeating last sample
-                data = raw.get_data()
                 padding_samples = target_samples - current_samples
-                log_print(f"  Padding with {padding_samples} samples ({padding_samples/raw.info['sfreq']:.2f}s)")
+                logger.info(f"  Padding with {padding_samples} samples ({padding_samples/raw.info['sfreq']:.2f}s)")
                 
                 # Record where zero padding starts
                 zero_padding_start = original_duration
-                log_print(f"  Zero padding starts at: {zero_padding_start:.2f}s")
+                logger.info(f"  Zero padding starts at: {zero_padding_start:.2f}s")
                 
-                # Create zero padding
-                zero_padding = np.zeros((data.shape[0], padding_samples))
-                padded_data = np.concatenate([data, zero_padding], axis=1)
+                # Allocate the final zero-padded shape once and copy the recorded samples in
+                padded_data = np.zeros((raw.info['nchan'], target_samples))
+                padded_data[:, :current_samples] = raw._data
                 raw = mne.io.RawArray(padded_data, raw.info, verbose=False)
-                log_print(f"  Data padded to: {raw.times[-1]:.2f} seconds")
+                logger.info(f"  Data padded to: {raw.times[-1]:.2f} seconds")
             elif target_samples < current_samples:
                 # Truncate if too long
-                log_print(f"  Truncating {current_samples - target_samples} samples")
-                data = raw.get_data()
-                truncated_data = data[:, :target_samples]
-                raw = mne.io.RawArray(truncated_data, raw.info, verbose=False)
-                log_print(f"  Data truncated to: {raw.times[-1]:.2f} seconds")
+                logger.info(f"  Truncating {current_samples - target_samples} samples")
+                # A float64 slice view is taken over by RawArray without copying
+                raw = mne.io.RawArray(raw._data[:, :target_samples], raw.info, verbose=False)
+                logger.info(f"  Data truncated to: {raw.times[-1]:.2f} seconds")
         
         actual_duration = raw.times[-1]
-        log_print(f"  EDF loaded: {raw.info['nchan']} channels, {actual_duration:.2f} seconds")
-        log_print(f"  Sampling rate: {raw.info['sfreq']} Hz")
-        log_print(f"  Final duration matches header: {abs(actual_duration - header_duration) < 0.1}")
+        logger.info(f"  EDF loaded: {raw.info['nchan']} channels, {actual_duration:.2f} seconds")
+        logger.info(f"  Sampling rate: {raw.info['sfreq']} Hz")
+        logger.info(f"  Final duration matches header: {abs(actual_duration - header_duration) < 0.1}")
         
         # 3. Get reference time from EDF metadata
-        log_print("\n3. Getting reference time from EDF metadata...")
-        reference_time = get_reference_time_from_edf_metadata(edf_file)
+        logger.info("\n3. Getting reference time from EDF metadata...")
+        reference_time = get_reference_time_from_edf_metadata(edf_file, metadata)
         
         # 4. Load events from all Excel files with EDF reference time
-        log_print("\n4. Loading events from Excel files...")
+        logger.info("\n4. Loading events from Excel files...")
         all_events = []
         excel_event_mapping = {}  # Map events to their Excel files
         
         for excel_file in excel_files:
-            log_print(f"\n  Processing: {excel_file}")
+            logger.info(f"\n  Processing: {excel_file}")
             events = load_excel_events(excel_file, reference_time=reference_time)
-            all_events.extend(events)
             
             # Store mapping for status updates
-            for event in events:
-                excel_event_mapping[len(all_events) - len(events) + events.index(event)] = excel_file
+            base = len(all_events)
+            all_events.extend(events)
+            for j in range(len(events)):
+                excel_event_mapping[base + j] = excel_file
         
         if not all_events:
-            log_print("  No events found, saving EDF without events")
+            logger.info("  No events found, saving EDF without events")
             if output_file:
-                mne.export.export_raw(output_file, raw, fmt='edf', overwrite=True)
-                log_print(f"  Saved: {output_file}")
+                if direct_read:
+                    _write_edfplus(output_file, edf_header, edf_data, mne.Annotations([], [], []))
+                else:
+                    mne.export.export_raw(output_file, raw, fmt='edf', overwrite=True)
+                logger.info(f"  Saved: {output_file}")
             return True
         
         # 5. Process events
-        log_print(f"\n5. Processing {len(all_events)} events...")
+        logger.info(f"\n5. Processing {len(all_events)} events...")
         
-        # Sort events by time
-        all_events.sort(key=lambda x: x.get('relative_time', x['time_seconds']))
+        # Sort events by time, carrying the Excel file mapping along with the new positions
+        order = sorted(range(len(all_events)), key=lambda j: all_events[j].get('relative_time', all_events[j]['time_seconds']))
+        all_events = [all_events[j] for j in order]
+        excel_event_mapping = {i: excel_event_mapping[j] for i, j in enumerate(order)}
         
         # Debug: Show EDF duration vs last event timing
         if all_events:
             last_event = all_events[-1]
             last_relative_time = last_event.get('relative_time', last_event['time_seconds'])
-            log_print(f"\n  === Duration Debug Info ===")
-            log_print(f"  EDF actual duration: {actual_duration:.2f} seconds")
-            log_print(f"  Last event relative time: {last_relative_time:.2f} seconds")
-            log_print(f"  Time difference: {actual_duration - last_relative_time:.2f} seconds")
-            log_print(f"  Last event within range: {0 <= last_relative_time <= actual_duration}")
-            log_print(f"  Last event details: {last_event['event_type']} at {last_event.get('time', 'N/A')}")
-            log_print(f"  =========================\n")
-        
-        # Convert to relative times and create annotations
-        onsets = []
-        durations = []
-        descriptions = []
-        event_status = []  # Track which events were included/excluded and why
-        
-        for i, event in enumerate(all_events):
-            # Use relative_time if available, otherwise calculate from first event
-            if 'relative_time' in event:
-                relative_time = event['relative_time']
-            else:
-                # Fallback: use first event as reference
-                if not onsets:
-                    ref_time = event['time_seconds']
-                    relative_time = 0.0
-                else:
-                    relative_time = event['time_seconds'] - ref_time
-            
-            # Debug: Show detailed info for last few events
-            if i >= len(all_events) - 3:  # Show last 3 events
-                log_print(f"  Event {i+1}/{len(all_events)}: {event['event_type']}")
-                log_print(f"    Relative time: {relative_time:.2f}s")
-                log_print(f"    Within range (0-{actual_duration:.2f}s): {0 <= relative_time <= actual_duration}")
-                log_print(f"    Time to EDF end: {actual_duration - relative_time:.2f}s")
-            
-            # Check if event is in zero padding area
-            in_zero_padding = False
-            if zero_padding_start is not None and relative_time >= zero_padding_start:
-                in_zero_padding = True
-                log_print(f"  Skipped: {event['event_type']} at {relative_time:.2f}s (in zero padding area: {zero_padding_start:.2f}s+)")
-                event_status.append(f"EXCLUDED_ZERO_PADDING")
-                continue
-            
-            # Allow events that are very close to the end (within 0.1 seconds)
-            tolerance = 0.1
-            if relative_time >= 0 and relative_time <= actual_duration + tolerance:
-                # If event is slightly beyond duration, clamp it to the end
-                if relative_time > actual_duration:
-                    relative_time = actual_duration
-                    log_print(f"  Adjusted: {event['event_type']} clamped to EDF end ({actual_duration:.2f}s)")
-                
-                onsets.append(relative_time)
-                durations.append(0.0)  # Point events
-                descriptions.append(event['event_type'])
-                event_status.append(f"INCLUDED")
-                if i < len(all_events) - 3:  # Don't duplicate debug info
-                    log_print(f"  Event: {event['event_type']} at {relative_time:.2f}s")
-            else:
-                log_print(f"  Skipped: {event['event_type']} at {relative_time:.2f}s (outside EDF range: 0-{actual_duration:.2f}s)")
-                event_status.append(f"EXCLUDED_OUT_OF_RANGE")
+            logger.info(f"\n  === Duration Debug Info ===")
+            logger.info(f"  EDF actual duration: {actual_duration:.2f} seconds")
+            logger.info(f"  Last event relative time: {last_relative_time:.2f} seconds")
+            logger.info(f"  Time difference: {actual_duration - last_relative_time:.2f} seconds")
+            logger.info(f"  Last event within range: {0 <= last_relative_time <= actual_duration}")
+            logger.info(f"  Last event details: {last_event['event_type']} at {last_event.get('time', 'N/A')}")
+            logger.info(f"  =========================\n")
+        
+        # Relative times for all events; without an EDF reference time the first event is time 0
+        rel_times = np.fromiter((event.get('relative_time', event['time_seconds']) for event in all_events),
+                                dtype=np.float64, count=len(all_events))
+        if reference_time is None:
+            rel_times -= rel_times[0]
+        
+        # Debug: Show detailed info for last few events
+        for i in range(max(len(all_events) - 3, 0), len(all_events)):
+            logger.info(f"  Event {i+1}/{len(all_events)}: {all_events[i]['event_type']}")
+            logger.info(f"    Relative time: {rel_times[i]:.2f}s")
+            logger.info(f"    Within range (0-{actual_duration:.2f}s): {0 <= rel_times[i] <= actual_duration}")
+            logger.info(f"    Time to EDF end: {actual_duration - rel_times[i]:.2f}s")
+        
+        # Classify all events at once: zero padding area first, then the EDF range,
+        # allowing events that are very close to the end (within 0.1 seconds)
+        tolerance = 0.1
+        if zero_padding_start is not None:
+            in_zero_padding = rel_times >= zero_padding_start
+        else:
+            in_zero_padding = np.zeros(len(rel_times), dtype=bool)
+        in_range = (rel_times >= 0) & (rel_times <= actual_duration + tolerance)
+        included = ~in_zero_padding & in_range
+        clamped = included & (rel_times > actual_duration)
+        
+        # Track which events were included/excluded and why
+        event_status = np.where(in_zero_padding, "EXCLUDED_ZERO_PADDING",
+                                np.where(in_range, "INCLUDED", "EXCLUDED_OUT_OF_RANGE")).tolist()
+        
+        for i in np.flatnonzero(in_zero_padding):
+            logger.info(f"  Skipped: {all_events[i]['event_type']} at {rel_times[i]:.2f}s (in zero padding area: {zero_padding_start:.2f}s+)")
+        for i in np.flatnonzero(~in_zero_padding & ~in_range):
+            logger.info(f"  Skipped: {all_events[i]['event_type']} at {rel_times[i]:.2f}s (outside EDF range: 0-{actual_duration:.2f}s)")
+        for i in np.flatnonzero(clamped):
+            logger.info(f"  Adjusted: {all_events[i]['event_type']} clamped to EDF end ({actual_duration:.2f}s)")
+        
+        # If an included event is slightly beyond duration, clamp it to the end
+        np.minimum(rel_times, actual_duration, out=rel_times, where=included)
+        onsets = rel_times[included]
+        descriptions = [all_events[i]['event_type'] for i in np.flatnonzero(included)]
         
         # 6. Add annotations to raw data
-        log_print("\n6. Adding events to EDF...")
+        logger.info("\n6. Adding events to EDF...")
         annotations = mne.Annotations(
             onset=onsets,
-            duration=durations,
+            duration=np.zeros(len(onsets)),  # Point events
             description=descriptions
         )
         raw.set_annotations(annotations)
-        log_print(f"  Added {len(onsets)} events to EDF")
+        logger.info(f"  Added {len(onsets)} events to EDF")
         
         # 6.5. Update Excel files with event status
-        log_print("\n6.5. Updating Excel files with event status...")
+        logger.info("\n6.5. Updating Excel files with event status...")
         excel_status_updates = {}  # Group status updates by Excel file
         
         for i, status in enumerate(event_status):
@@ -683,21 +789,27 @@ def convert_edf_to_edfplus(edf_file, output_file=None):
                         'status': status
                     })
         
-        # Update each Excel file
-        for excel_file, status_updates in excel_status_updates.items():
-            update_excel_event_status(excel_file, status_updates)
+        # Update each Excel file now, or queue the updates (Excel file -> list of updates)
+        # so a batch run loads and saves each workbook only once
+        if pending_updates is None:
+            flush_excel_event_status(excel_status_updates)
+        else:
+            for excel_file, status_updates in excel_status_updates.items():
+                pending_updates.setdefault(excel_file, []).extend(status_updates)
+            logger.info(f"  Queued status updates for {len(excel_status_updates)} Excel files")
         
         # 7. Generate correct filename and save as EDF+
-        log_print("\n7. Generating correct filename and saving EDF+ file...")
+        logger.info("\n7. Generating correct filename and saving EDF+ file...")
         
         # Generate correct filename based on EDF metadata
-        correct_filename = generate_correct_filename(edf_file)
+        correct_filename = generate_correct_filename(edf_file, metadata)
         if not correct_filename:
-            log_print("  Warning: Could not generate correct filename, using original filename")
+            logger.warning("  Warning: Could not generate correct filename, using original filename")
             correct_filename = os.path.basename(edf_file)
         
+        backup_file = None
         if output_file is None:
-            # Rename original file to backup with final filename info
+            # The original file is kept as a backup with final filename info
             edf_path = Path(edf_file)
             original_stem = edf_path.stem  # original file name (without extension)
             final_stem = correct_filename.replace('.edf', '')  # final file name (without extension)
@@ -705,155 +817,283 @@ def convert_edf_to_edfplus(edf_file, output_file=None):
             # backup file name: original file name_backup_final file name.edf
             backup_file = edf_path.parent / f"{original_stem}_backup_{final_stem}.edf"
             
-            # Rename original file to backup
-            import shutil
-            shutil.move(edf_file, backup_file)
-            log_print(f"  Original file renamed to backup: {backup_file.name}")
-            
             # Use correct filename for EDF+ output
             output_file = edf_path.parent / correct_filename
         
-        # Save using MNE's built-in EDF+ export functionality
         # Verify duration before saving
         final_duration = raw.times[-1]
-        log_print(f"  Final duration before saving: {final_duration:.2f} seconds")
-        
-        mne.export.export_raw(output_file, raw, fmt='edf', overwrite=True)
+        logger.info(f"  Final duration before saving: {final_duration:.2f} seconds")
         
-        # Verify the saved file duration
+        # Write a temporary file next to the output; only a complete EDF+ file is renamed into place,
+        # so a conversion killed while writing leaves the original file untouched
+        temp_file = Path(output_file).with_name(Path(output_file).name + '.tmp')
         try:
-            saved_raw = mne.io.read_raw_edf(output_file, preload=False, verbose=False)
-            saved_duration = saved_raw.times[-1]
-            log_print(f"  Saved file duration: {saved_duration:.2f} seconds")
+            if direct_read:
+                # Write the original digital samples as EDF+ (no float round trip through MNE's exporter)
+                _write_edfplus(temp_file, edf_header, edf_data, annotations)
+            else:
+                # Save using MNE's built-in EDF+ export functionality
+                mne.export.export_raw(temp_file, raw, fmt='edf', overwrite=True)
+        except Exception:
+            temp_file.unlink(missing_ok=True)
+            raise
+        
+        if backup_file is not None:
+            # Rename original file to backup (same directory, so one atomic rename without copying)
+            os.replace(edf_file, backup_file)
+            logger.info(f"  Original file renamed to backup: {backup_file.name}")
+        os.replace(temp_file, output_file)
+        
+        # Verify the saved file duration (from its header only); like raw.times[-1], it ends at the last sample
+        try:
+            saved_duration = edf_header_duration(output_file) - 1 / raw.info['sfreq']
+            logger.info(f"  Saved file duration: {saved_duration:.2f} seconds")
             
             if abs(saved_duration - final_duration) > 0.1:
-                log_print(f"  ⚠️  WARNING: Duration mismatch after saving!")
-                log_print(f"     Original: {final_duration:.2f}s, Saved: {saved_duration:.2f}s")
+                logger.warning(f"  ⚠️  WARNING: Duration mismatch after saving!")
+                logger.info(f"     Original: {final_duration:.2f}s, Saved: {saved_duration:.2f}s")
             else:
-                log_print(f"  ✓ Duration preserved correctly")
+                logger.info(f"  ✓ Duration preserved correctly")
         except Exception as e:
-            log_print(f"  Could not verify saved file duration: {e}")
+            logger.info(f"  Could not verify saved file duration: {e}")
         
-        log_print(f"  ✓ EDF+ file saved: {output_file}")
-        log_print(f"  ✓ Filename based on EDF metadata: {correct_filename}")
+        logger.info(f"  ✓ EDF+ file saved: {output_file}")
+        logger.info(f"  ✓ Filename based on EDF metadata: {correct_filename}")
         
         return True
         
     except Exception as e:
-        log_print(f"Error during conversion: {e}")
+        logger.error(f"Error during conversion: {e}")
         return False
 
 
-def run_relative_time_processing():
-    """Run relative.py to add relative time to Excel files"""
-    log_print("=== Running relative time processing ===")
+def run_relative_time_processing(base_dir="."):
+    """Run relative.py in process to add relative time to Excel files"""
+    logger.info("=== Running relative time processing ===")
     try:
-        # Import and run the relative time processing
-        import subprocess
-        import sys
-        
-        result = subprocess.run([sys.executable, "relative.py"], 
-                              capture_output=True, text=True, cwd=".")
-        
-        if result.returncode == 0:
-            log_print("✓ Relative time processing completed successfully")
-            log_print(result.stdout)
-        else:
-            log_print("✗ Relative time processing failed")
-            log_print("STDOUT:", result.stdout)
-            log_print("STDERR:", result.stderr)
-            return False
-            
+        relative.main(base_dir)
     except Exception as e:
-        log_print(f"Error running relative time processing: {e}")
+        logger.error(f"✗ Relative time processing failed: {e}")
         return False
     
+    logger.info("✓ Relative time processing completed successfully")
     return True
 
 
-def process_all_edf_files(base_dir="."):
+def _init_worker():
+    """Prepare a worker process: drop inherited handlers and capture log records per conversion"""
+    global _capture_logs
+    _capture_logs = True
+    root_logger = logging.getLogger()
+    root_logger.handlers.clear()
+    root_logger.setLevel(logging.INFO)
+
+
+def convert_one(edf_file, direct_read=False):
+    """Convert one EDF file; returns (edf_file, success, captured log records, queued Excel updates)"""
+    log_records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(log_records)
+    if _capture_logs:
+        logging.getLogger().addHandler(handler)
+    
+    pending_updates = {}
+    try:
+        success = convert_edf_to_edfplus(edf_file, pending_updates=pending_updates, direct_read=direct_read)
+    except Exception as e:
+        logger.error(f"✗ Error processing {edf_file.name}: {e}")
+        success = False
+    finally:
+        logging.getLogger().removeHandler(handler)
+    
+    records = []
+    while not log_records.empty():
+        records.append(log_records.get())
+    return edf_file, success, records, pending_updates
+
+
+def _restore_interrupted_backup(edf_file):
+    """Rename the backup of edf_file back to it if a killed conversion already made one"""
+    edf_path = Path(edf_file)
+    prefix = f"{edf_path.stem}_backup_"
+    for name in os.listdir(edf_path.parent):
+        if name.startswith(prefix) and name.endswith('.edf'):
+            os.replace(edf_path.parent / name, edf_path)
+            logger.info(f"Restored {edf_path.name} from the backup of an interrupted conversion: {name}")
+            return
+
+
+def _convert_in_workers(edf_files, direct_read=False, jobs=1):
+    """Yield (edf_file, get_result) for each EDF file as soon as a worker process finishes converting it"""
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker)
+    crashed = []
+    try:
+        futures = {executor.submit(convert_one, edf_file, direct_read): edf_file for edf_file in edf_files}
+        for future in as_completed(futures):
+            if isinstance(future.exception(), BrokenProcessPool):
+                crashed.append(futures[future])
+            else:
+                yield futures[future], future.result
+    finally:
+        executor.shutdown(cancel_futures=True)
+    
+    # A worker that dies (e.g. killed for running out of memory) breaks the whole pool and terminates
+    # every other worker, failing every file still pending in it, so retry those one at a time: only a
+    # file that crashes on its own fails. A terminated conversion may already have renamed its original
+    # to the backup and put the EDF+ output in place, so it is converted again from the restored original.
+    for edf_file in crashed:
+        _restore_interrupted_backup(edf_file)
+        executor = ProcessPoolExecutor(max_workers=1, initializer=_init_worker)
+        try:
+            future = executor.submit(convert_one, edf_file, direct_read)
+            future.exception()
+        finally:
+            executor.shutdown()
+        yield edf_file, future.result
+
+
+def process_all_edf_files(base_dir=".", direct_read=False, jobs=None):
     """Process all EDF files in the directory and subdirectories"""
     base_path = Path(base_dir)
     
-    # First, run relative time processing
-    log_print("Step 1: Adding relative time to Excel files...")
-    if not run_relative_time_processing():
-        log_print("Failed to process relative time. Continuing with EDF conversion...")
+    # Find all EDF files recursively in one pass, setting aside backup files
+    edf_files = []
+    backup_files = []
+    for root, _, names in os.walk(base_path):
+        for name in names:
+            if not name.endswith(".edf"):
+                continue
+            f = Path(root) / name
+            if "_backup_" in f.stem:
+                backup_files.append(f)
+            elif "_backup" not in f.name and "_with_events" not in f.name:
+                edf_files.append(f)
     
-    log_print("\nStep 2: Converting EDF files to EDF+...")
+    # A backup (original_backup_final.edf) marks final.edf next to it as the EDF+ output of a previous run.
+    # Only a complete output is skipped: the backup of a missing or truncated one (an interrupted run)
+    # is renamed back to its original name, before step 1 reads its header, and converted again.
+    converted_files = set()
+    for backup_file in backup_files:
+        original_stem, final_stem = backup_file.stem.split("_backup_", 1)
+        output_file = backup_file.with_name(final_stem + ".edf")
+        if edf_file_complete(output_file):
+            converted_files.add(output_file)
+            continue
+        original_file = backup_file.with_name(original_stem + ".edf")
+        if original_file.exists() and original_file != output_file:
+            continue
+        logger.warning(f"Incomplete output of an earlier run, restoring {original_file.name} from {backup_file.name}")
+        os.replace(backup_file, original_file)
+        if original_file not in edf_files:
+            edf_files.append(original_file)
     
-    # Find all EDF files recursively
-    edf_files = list(base_path.rglob("*.edf"))
+    # First, run relative time processing
+    logger.info("Step 1: Adding relative time to Excel files...")
+    if not run_relative_time_processing(base_dir):
+        logger.warning("Failed to process relative time. Continuing with EDF conversion...")
+    
+    logger.info("\nStep 2: Converting EDF files to EDF+...")
     
-    # Filter out backup files and already processed files
-    edf_files = [f for f in edf_files if "_backup" not in f.name and "_with_events" not in f.name]
+    # Complete outputs of earlier runs keep their Excel statuses: step 1 keeps a non-empty F whenever E is unchanged
+    for f in edf_files:
+        if f in converted_files:
+            logger.info(f"Skipping already converted file: {f}")
+    edf_files = [f for f in edf_files if f not in converted_files]
     
     if not edf_files:
-        log_print("No EDF files found in the directory")
+        logger.info("No EDF files found in the directory")
         return
     
-    log_print(f"=== Found {len(edf_files)} EDF files to process ===")
+    logger.info(f"=== Found {len(edf_files)} EDF files to process ===")
     for i, edf_file in enumerate(edf_files, 1):
-        log_print(f"{i}. {edf_file}")
+        logger.info(f"{i}. {edf_file}")
+    
+    # Process each EDF file; Excel status updates are collected and written once at the end.
+    # With several jobs, files are converted in worker processes and each file's log is replayed here
+    # as soon as it finishes, so a long recording does not hold back the report of the others.
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(edf_files))
+    logger.info(f"Parallel jobs: {jobs}")
     
-    # Process each EDF file
     success_count = 0
     failed_files = []
+    pending_updates = {}
     
-    for i, edf_file in enumerate(edf_files, 1):
-        log_print(f"\n{'='*60}")
-        log_print(f"Processing {i}/{len(edf_files)}: {edf_file.name}")
-        log_print(f"{'='*60}")
+    if jobs > 1:
+        completed = _convert_in_workers(edf_files, direct_read, jobs)
+    else:
+        completed = ((edf_file, functools.partial(convert_one, edf_file, direct_read)) for edf_file in edf_files)
+    
+    for i, (edf_file, get_result) in enumerate(completed, 1):
+        logger.info(f"\n{'='*60}")
+        logger.info(f"Processing {i}/{len(edf_files)}: {edf_file.name}")
+        logger.info(f"{'='*60}")
         
+        # A file whose worker crashed even when retried alone fails without its log
         try:
-            success = convert_edf_to_edfplus(edf_file)
-            if success:
-                success_count += 1
-                log_print(f"✓ Success: {edf_file.name}")
-            else:
-                failed_files.append(edf_file)
-                log_print(f"✗ Failed: {edf_file.name}")
+            _, success, records, updates = get_result()
         except Exception as e:
+            logger.error(f"✗ Error processing {edf_file.name}: {e}")
+            success, records, updates = False, [], {}
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+        for excel_file, status_updates in updates.items():
+            pending_updates.setdefault(excel_file, []).extend(status_updates)
+        
+        if success:
+            success_count += 1
+            logger.info(f"✓ Success: {edf_file.name}")
+        else:
             failed_files.append(edf_file)
-            log_print(f"✗ Error processing {edf_file.name}: {e}")
+            logger.error(f"✗ Failed: {edf_file.name}")
+    
+    logger.info(f"\nUpdating Excel files with event status...")
+    flush_excel_event_status(pending_updates)
     
     # Summary
-    log_print(f"\n{'='*60}")
-    log_print(f"=== PROCESSING COMPLETE ===")
-    log_print(f"Total files: {len(edf_files)}")
-    log_print(f"Successful: {success_count}")
-    log_print(f"Failed: {len(failed_files)}")
+    logger.info(f"\n{'='*60}")
+    logger.info(f"=== PROCESSING COMPLETE ===")
+    logger.info(f"Total files: {len(edf_files)}")
+    logger.info(f"Successful: {success_count}")
+    logger.info(f"Failed: {len(failed_files)}")
     
     if failed_files:
-        log_print(f"\nFailed files:")
+        logger.info(f"\nFailed files:")
         for failed_file in failed_files:
-            log_print(f"  - {failed_file}")
+            logger.info(f"  - {failed_file}")
     
-    log_print(f"{'='*60}")
+    logger.info(f"{'='*60}")
 
 
 def main():
     """Main function"""
-    import sys
+    parser = argparse.ArgumentParser(description="Convert EDF files with Excel events to EDF+ format")
+    parser.add_argument('base_dir', nargs='?', help="directory to process (default: current directory)")
+    parser.add_argument('--direct-read', action='store_true',
+                        help="read EDF samples with the built-in reader and write the EDF+ file "
+                             "from the original digital samples instead of going through MNE")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="number of EDF files converted in parallel (default: number of CPU cores)")
+    args = parser.parse_args()
     
     # Setup logging
     log_filename = setup_logging()
-    log_print(f"=== EDF2EDF+ Converter Started ===")
-    log_print(f"Log file: {log_filename}")
+    logger.info(f"=== EDF2EDF+ Converter Started ===")
+    logger.info(f"Log file: {log_filename}")
     
-    if len(sys.argv) > 1:
+    if args.base_dir:
         # If directory path provided as argument
-        base_dir = sys.argv[1]
-        log_print(f"Processing directory: {base_dir}")
+        base_dir = args.base_dir
+        logger.info(f"Processing directory: {base_dir}")
     else:
         # Use current directory
         base_dir = "."
-        log_print(f"Processing current directory: {os.getcwd()}")
+        logger.info(f"Processing current directory: {os.getcwd()}")
     
-    process_all_edf_files(base_dir)
+    process_all_edf_files(base_dir, direct_read=args.direct_read, jobs=args.jobs)
     
-    log_print(f"=== EDF2EDF+ Converter Finished ===")
-    log_print(f"Log saved to: {log_filename}")
+    logger.info(f"=== EDF2EDF+ Converter Finished ===")
+    logger.info(f"Log saved to: {log_filename}")
 
 
 if __name__ == "__main__":
@@ -9,11 +9,39 @@ Features:
 """
 
 import os
-import glob
 import re
-import openpyxl
+import struct
+import json
+import atexit
+import functools
+import sys
+import logging
+import numpy as np
 from datetime import datetime
-import mne
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# EDF general header: fixed-width ASCII fields, 256 bytes in total
+EDF_HEADER_STRUCT = struct.Struct('8s80s80s8s8s8s44s8s8s4s')
+EDF_HEADER_FIELDS = ('version', 'patient_id', 'recording_id', 'start_date', 'start_time',
+                     'header_bytes', 'reserved', 'records', 'duration', 'nsignals')
+
+logger = logging.getLogger(__name__)
+
+# EDF reference times kept across runs: resolved path -> [mtime_ns, size, reference seconds]
+EDF_REF_CACHE_FILE = '.edf_ref_cache.json'
+_edf_ref_cache_path = EDF_REF_CACHE_FILE
+_edf_ref_cache = {}
+_edf_ref_cache_dirty = False
+
+# Event time in HH:MM:SS.SS format (hours may have one digit)
+_TIME_RE = re.compile(r'(\d{1,2}):(\d{2}):(\d{2}\.?\d*)')
+
+# EDF header start time, HH.MM.SS (seconds optional)
+_EDF_TIME_RE = re.compile(r'(\d+)\.(\d+)(?:\.(\d+))?')
+
+# YYYYMMDD date in Excel file paths
+_DATE_RE = re.compile(r'(\d{8})')
 
 def time_to_seconds(time_str):
     """Convert time string in HH:MM:SS.SS format to seconds"""
@@ -23,9 +51,26 @@ def time_to_seconds(time_str):
     # Clean string (remove leading/trailing spaces)
     time_str = str(time_str).strip()
     
-    # Check if it's in HH:MM:SS.SS format
-    time_pattern = r'(\d{1,2}):(\d{2}):(\d{2}\.?\d*)'
-    match = re.match(time_pattern, time_str)
+    total_seconds = _parse_time_str(time_str)
+    if total_seconds is None:
+        logger.warning(f"  Warning: Cannot recognize time format: '{time_str}'")
+        return 0
+    return total_seconds
+
+@functools.lru_cache(maxsize=8192)
+def _parse_time_str(time_str):
+    """Parse a stripped HH:MM:SS.SS string to seconds, or None if unrecognized (cached: times repeat across rows)"""
+    # Fast path: a plain H:MM:SS(.ss) string splits into three numeric parts
+    parts = time_str.split(':')
+    if len(parts) == 3:
+        hours, minutes, seconds = parts
+        whole, _, fraction = seconds.partition('.')
+        if (hours.isdecimal() and len(hours) <= 2 and minutes.isdecimal() and len(minutes) == 2
+                and whole.isdecimal() and len(whole) == 2 and (fraction.isdecimal() or not fraction)):
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    
+    # Check if it's in HH:MM:SS.SS format (also accepts trailing text after the seconds)
+    match = _TIME_RE.match(time_str)
     
     if match:
         hours = int(match.group(1))
@@ -34,248 +79,301 @@ def time_to_seconds(time_str):
         
         total_seconds = hours * 3600 + minutes * 60 + seconds
         return total_seconds
-    else:
-        print(f"  Warning: Cannot recognize time format: '{time_str}'")
-        return 0
+    return None
 
+@functools.lru_cache(maxsize=8192)
 def parse_edf_time_to_seconds(edf_time_str):
     """Parse EDF time string (HH.MM.SS) to seconds"""
-    try:
-        # EDF time format: HH.MM.SS (with dots)
-        parts = edf_time_str.split('.')
-        if len(parts) >= 3:
-            hours = float(parts[0])
-            minutes = float(parts[1])
-            seconds = float(parts[2])
-            return hours * 3600 + minutes * 60 + seconds
-        elif len(parts) == 2:
-            # If only HH.MM format, assume seconds as 0
-            hours = float(parts[0])
-            minutes = float(parts[1])
-            seconds = 0.0
-            return hours * 3600 + minutes * 60 + seconds
-        return 0.0
-    except:
+    # Fast path: header times are fixed-width HH.MM.SS, so read the ASCII digits directly
+    if len(edf_time_str) == 8 and edf_time_str.isascii():
+        b = edf_time_str.encode('ascii')
+        if b[2] == b[5] == ord('.') and (b[0:2] + b[3:5] + b[6:8]).isdigit():
+            return float(((b[0] - 48) * 10 + (b[1] - 48)) * 3600
+                         + ((b[3] - 48) * 10 + (b[4] - 48)) * 60
+                         + ((b[6] - 48) * 10 + (b[7] - 48)))
+    
+    # Other layouts: HH.MM.SS with any digit counts; HH.MM is read with seconds as 0
+    match = _EDF_TIME_RE.match(edf_time_str)
+    if not match:
         return 0.0
+    hours, minutes, seconds = match.groups(default='0')
+    return float(int(hours) * 3600 + int(minutes) * 60 + int(seconds))
+
+def unpack_edf_header(data):
+    """Split the 256-byte EDF general header into a dict of stripped strings"""
+    fields = EDF_HEADER_STRUCT.unpack(data)
+    return {name: value.strip().decode('latin-1') for name, value in zip(EDF_HEADER_FIELDS, fields)}
+
+def _read_edf_header_fields(edf_file):
+    """Read the EDF general header of a file"""
+    with open(edf_file, 'rb') as f:
+        return unpack_edf_header(f.read(EDF_HEADER_STRUCT.size))
 
 def extract_edf_metadata(edf_file):
     """Extract metadata from EDF file header"""
     try:
-        with open(edf_file, 'rb') as f:
-            # Read EDF header (256 bytes)
-            header_bytes = f.read(256)
-            header_str = header_bytes.decode('ascii', errors='ignore')
-            
-            # Parse header information
-            metadata = {}
-            metadata['version'] = header_str[0:8].strip()
-            metadata['patient_id'] = header_str[8:88].strip()
-            metadata['recording_id'] = header_str[88:168].strip()
-            metadata['start_date'] = header_str[168:176].strip()  # DD.MM.YY format
-            metadata['start_time'] = header_str[176:184].strip()  # HH.MM.SS format
-            metadata['header_bytes'] = header_str[184:192].strip()
-            metadata['reserved'] = header_str[192:236].strip()
-            metadata['records'] = header_str[236:244].strip()
-            metadata['duration'] = header_str[244:252].strip()
-            metadata['nsignals'] = header_str[252:256].strip()
-            
-            return metadata
+        # start_date is DD.MM.YY, start_time is HH.MM.SS
+        return _read_edf_header_fields(edf_file)
     except Exception as e:
-        print(f"  Error reading EDF metadata: {e}")
+        logger.error(f"  Error reading EDF metadata: {e}")
         return None
 
-def get_edf_reference_time(edf_file):
-    """Get reference time from EDF metadata start time"""
+def load_edf_ref_cache(base_dir="."):
+    """Load cached EDF reference times and save them again when the script exits"""
+    global _edf_ref_cache, _edf_ref_cache_path
+    _edf_ref_cache_path = os.path.join(base_dir, EDF_REF_CACHE_FILE)
+    try:
+        with open(_edf_ref_cache_path, 'r', encoding='utf-8') as f:
+            _edf_ref_cache = json.load(f)
+    except (OSError, ValueError):
+        _edf_ref_cache = {}
+    atexit.unregister(save_edf_ref_cache)
+    atexit.register(save_edf_ref_cache)
+
+def save_edf_ref_cache():
+    """Write the EDF reference time cache if anything new was added"""
+    if not _edf_ref_cache_dirty:
+        return
     try:
-        metadata = extract_edf_metadata(edf_file)
+        with open(_edf_ref_cache_path, 'w', encoding='utf-8') as f:
+            json.dump(_edf_ref_cache, f)
+    except OSError as e:
+        logger.warning(f"  Warning: Could not save EDF reference cache: {e}")
+
+def get_cached_edf_reference_time(edf_file):
+    """Cached reference time of an EDF file, or None if it is not cached or the file has changed"""
+    st = os.stat(edf_file)
+    cached = _edf_ref_cache.get(str(Path(edf_file).resolve()))
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    return None
+
+def get_edf_reference_time(edf_file, metadata=None):
+    """Get reference time from EDF metadata start time (header read from the file unless given)"""
+    global _edf_ref_cache_dirty
+    try:
+        # Reuse the reference time while the EDF file is unchanged (same mtime and size)
+        cached = get_cached_edf_reference_time(edf_file)
+        if cached is not None:
+            logger.info(f"  Reference time (EDF start, cached): {cached:.2f}s")
+            return cached
+        
+        st = os.stat(edf_file)
+        if metadata is None:
+            metadata = extract_edf_metadata(edf_file)
         if not metadata:
             return None
         
         start_time_str = metadata['start_time']
         reference_seconds = parse_edf_time_to_seconds(start_time_str)
         
-        print(f"  EDF start time: {start_time_str}")
-        print(f"  Reference time (EDF start): {reference_seconds:.2f}s")
+        logger.info(f"  EDF start time: {start_time_str}")
+        logger.info(f"  Reference time (EDF start): {reference_seconds:.2f}s")
+        _edf_ref_cache[str(Path(edf_file).resolve())] = [st.st_mtime_ns, st.st_size, reference_seconds]
+        _edf_ref_cache_dirty = True
         return reference_seconds
         
     except Exception as e:
-        print(f"Error getting EDF reference time: {e}")
+        logger.error(f"Error getting EDF reference time: {e}")
         return None
 
-def find_matching_edf_file(excel_file):
-    """Find matching EDF file for the given Excel file"""
+def list_edf_files(directory):
+    """Names of the .edf entries of a directory, in directory order"""
+    with os.scandir(directory or '.') as entries:
+        return [entry.name for entry in entries if entry.name.endswith('.edf')]
+
+def find_matching_edf_file(excel_file, edf_index=None):
+    """Find matching EDF file for the given Excel file (edf_index caches directory listings)"""
     try:
         # Extract base name from Excel file (remove .xlsx)
-        base_name = os.path.splitext(excel_file)[0]
+        base_name = os.path.basename(os.path.splitext(excel_file)[0])
+        directory = os.path.dirname(excel_file)
+        
+        # List each directory's EDF files only once
+        if edf_index is None:
+            edf_index = {}
+        if directory not in edf_index:
+            edf_index[directory] = list_edf_files(directory)
+        edf_names = edf_index[directory]
         
         # Look for EDF file with same base name
-        edf_file = base_name + '.edf'
-        if os.path.exists(edf_file):
-            return edf_file
+        if base_name + '.edf' in edf_names:
+            return os.path.join(directory, base_name + '.edf')
         
         # If not found, try to find in the same directory
-        directory = os.path.dirname(excel_file)
         if directory:
-            edf_pattern = os.path.join(directory, os.path.basename(base_name) + '*.edf')
-            edf_files = glob.glob(edf_pattern)
-            if edf_files:
-                return edf_files[0]  # Return first match
+            for name in edf_names:
+                if name.startswith(base_name):
+                    return os.path.join(directory, name)  # Return first match
         
         return None
         
     except Exception as e:
-        print(f"  Error finding EDF file for {excel_file}: {e}")
+        logger.error(f"  Error finding EDF file for {excel_file}: {e}")
         return None
 
 def process_excel_file(file_path, start_time):
     """Process single Excel file to add relative time"""
-    print(f"\nProcessing: {file_path}")
+    import openpyxl
+    
+    logger.info(f"\nProcessing: {file_path}")
     
     try:
+        # Update the sheet in place: only columns E and F change
         wb = openpyxl.load_workbook(file_path)
         ws = wb.active
         
-        # Convert data to list
-        data = []
-        for row_num in range(1, ws.max_row + 1):
-            row_values = []
-            for col_num in range(1, ws.max_column + 1):
-                cell_value = ws.cell(row=row_num, column=col_num).value
-                row_values.append(cell_value)
-            data.append(row_values)
-        
         # Remove first empty row
-        if data and all(cell is None for cell in data[0]):
-            data = data[1:]
-            print("  Removed first empty row.")
+        removed_empty_row = all(cell.value is None for cell in ws[1])
+        if removed_empty_row:
+            ws.delete_rows(1)
+            logger.info("  Removed first empty row.")
         
-        print(f"  Data size: {len(data)} rows x {len(data[0]) if data else 0} columns")
+        logger.info(f"  Data size: {ws.max_row} rows x {ws.max_column} columns")
         
-        # Find time column (column C, index 2)
-        time_col = 2
-        if len(data[0]) < 3:
-            print("  Warning: Column C not found.")
+        # Find time column (column C)
+        if ws.max_column < 3:
+            logger.warning("  Warning: Column C not found.")
             return False
         
-        # Add column E (index 4) and F (index 5) for relative time and status
-        for i in range(len(data)):
-            while len(data[i]) < 6:
-                data[i].append(None)
+        # Convert every row's time to seconds, then all relative times in one vectorized pass
+        rows = list(ws.iter_rows(min_col=3, max_col=6))
+        times = [row[0].value for row in rows]
+        has_time = [time_val is not None and str(time_val).strip() != '' for time_val in times]
+        current_times = np.fromiter((time_to_seconds(time_val) for time_val, ok in zip(times, has_time) if ok),
+                                    dtype=np.float64)
+        relative_times = iter(np.char.mod('%.2f', current_times - start_time).tolist())
         
-        # Convert each row's time to relative time and store in column E
-        # Initialize status column F with "PENDING" (will be updated by edf2edfplus.py)
-        for i in range(len(data)):
-            if len(data[i]) > time_col:
-                time_val = data[i][time_col]
-                if time_val is not None and str(time_val).strip() != '':
-                    current_time = time_to_seconds(time_val)
-                    relative_time = current_time - start_time
-                    data[i][4] = f"{relative_time:.2f}"  # Column E (index 4)
-                    data[i][5] = "PENDING"  # Column F (index 5) - Status
-                else:
-                    data[i][4] = ''
-                    data[i][5] = ''
-            else:
-                data[i][4] = ''
-                data[i][5] = ''
+        # Store relative time in column E and initialize status column F with "PENDING"
+        # (will be updated by edf2edfplus.py)
+        changed = False
+        results = []
+        for (_, _, relative_cell, status_cell), time_val, ok in zip(rows, times, has_time):
+            relative_time = next(relative_times) if ok else None
+            
+            # A row whose relative time is unchanged keeps the status a previous run
+            # (or edf2edfplus.py) already gave it
+            if ok and relative_cell.value == relative_time and status_cell.value:
+                results.append((time_val, relative_time, status_cell.value))
+                continue
+            
+            values = (relative_time, "PENDING") if ok else (None, None)
+            if (relative_cell.value, status_cell.value) != values:
+                relative_cell.value, status_cell.value = values
+                changed = True
+            results.append((time_val, *values))
         
         # Check results
-        print("  Conversion results:")
-        for i in range(min(3, len(data))):  # Show first 3 rows only
-            original_time = data[i][time_col] if len(data[i]) > time_col else None
-            relative_time = data[i][4] if len(data[i]) > 4 else None
-            status = data[i][5] if len(data[i]) > 5 else None
-            print(f"    Row {i+1}: {original_time} -> {relative_time}s [{status}]")
-        
-        # Create new workbook and save
-        new_wb = openpyxl.Workbook()
-        new_ws = new_wb.active
+        logger.info("  Conversion results:")
+        for i, (original_time, relative_time, status) in enumerate(results[:3]):  # Show first 3 rows only
+            logger.info(f"    Row {i+1}: {original_time} -> {relative_time or ''}s [{status or ''}]")
         
-        # Write data to new worksheet
-        for i, row_data in enumerate(data):
-            for j, cell_value in enumerate(row_data):
-                if cell_value is not None:
-                    new_ws.cell(row=i+1, column=j+1, value=cell_value)
+        # Skip the save when a previous run already stored the same values
+        if not changed and not removed_empty_row:
+            logger.info(f"  Already up to date, not saved: {file_path}")
+            return True
         
         # Save file
-        new_wb.save(file_path)
-        print(f"  Save complete: {file_path}")
+        wb.save(file_path)
+        logger.info(f"  Save complete: {file_path}")
         
         return True
         
     except Exception as e:
-        print(f"  Error occurred: {e}")
+        logger.error(f"  Error occurred: {e}")
         return False
 
-def get_edf_reference_times(file_list):
+def get_edf_reference_times(file_list, edf_index=None):
     """Get EDF reference times for all Excel files"""
     reference_times = {}
+    if edf_index is None:
+        edf_index = {}
     
-    for file_path in file_list:
+    # Match every Excel file to its EDF file first
+    edf_files = {file_path: find_matching_edf_file(file_path, edf_index) for file_path in file_list}
+    
+    # Read the headers of the uncached EDF files in a thread pool (blocking file I/O)
+    to_read = []
+    for edf_file in dict.fromkeys(edf_files.values()):
+        try:
+            if edf_file and get_cached_edf_reference_time(edf_file) is None:
+                to_read.append(edf_file)
+        except OSError:
+            pass
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+        headers = dict(zip(to_read, executor.map(extract_edf_metadata, to_read)))
+    
+    for file_path, edf_file in edf_files.items():
         try:
-            # Find matching EDF file
-            edf_file = find_matching_edf_file(file_path)
             if edf_file:
-                reference_time = get_edf_reference_time(edf_file)
+                if edf_file in headers and headers[edf_file] is None:
+                    reference_time = None  # Header could not be read (already reported)
+                else:
+                    reference_time = get_edf_reference_time(edf_file, headers.get(edf_file))
                 if reference_time is not None:
                     reference_times[file_path] = reference_time
-                    print(f"  Found EDF reference for {os.path.basename(file_path)}: {reference_time:.2f}s")
+                    logger.info(f"  Found EDF reference for {os.path.basename(file_path)}: {reference_time:.2f}s")
                 else:
-                    print(f"  Warning: Could not get EDF reference for {os.path.basename(file_path)}")
+                    logger.warning(f"  Warning: Could not get EDF reference for {os.path.basename(file_path)}")
             else:
-                print(f"  Warning: No matching EDF file found for {os.path.basename(file_path)}")
+                logger.warning(f"  Warning: No matching EDF file found for {os.path.basename(file_path)}")
         
         except Exception as e:
-            print(f"  Error processing {file_path}: {e}")
+            logger.error(f"  Error processing {file_path}: {e}")
             continue
     
     return reference_times
 
-def main():
+def main(base_dir="."):
     """Main function"""
-    print("=== Starting Excel event file time conversion (EDF-based) ===")
+    logger.info("=== Starting Excel event file time conversion (EDF-based) ===")
+    load_edf_ref_cache(base_dir)
     
-    # Find all Excel files with date pattern
-    excel_pattern = "**/*_*_*.xlsx"  # Pattern: anything_YYYYMMDD_HHMM.xlsx
-    all_excel_files = glob.glob(excel_pattern, recursive=True)
-    all_excel_files = [f for f in all_excel_files if not os.path.basename(f).startswith('~$')]
+    # Find all Excel files with date pattern (anything_YYYYMMDD_HHMM.xlsx), skipping hidden files and directories
+    all_excel_files = []
+    for root, dirs, files in os.walk(base_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if name.endswith('.xlsx') and name[:-5].count('_') >= 2 and not name.startswith(('.', '~$')):
+                all_excel_files.append(os.path.normpath(os.path.join(root, name)))
     
     if not all_excel_files:
-        print("No Excel files found.")
+        logger.info("No Excel files found.")
         return
     
-    print(f"Found Excel files: {len(all_excel_files)}")
+    logger.info(f"Found Excel files: {len(all_excel_files)}")
     
     # Group files by date
     date_groups = {}
     for file_path in all_excel_files:
         # Extract date from filename (YYYYMMDD)
-        date_match = re.search(r'(\d{8})', file_path)
+        date_match = _DATE_RE.search(os.path.relpath(file_path, base_dir))
         if date_match:
             date_str = date_match.group(1)
             if date_str not in date_groups:
                 date_groups[date_str] = []
             date_groups[date_str].append(file_path)
     
-    print(f"Found date groups: {len(date_groups)}")
+    logger.info(f"Found date groups: {len(date_groups)}")
     
-    # Process each date group
+    # Process each date group; directory listings are shared by all groups
     total_success = 0
     total_files = 0
+    edf_index = {}
     
     for date_str, file_list in date_groups.items():
-        print(f"\n=== Processing date {date_str} ===")
-        print(f"  Files: {len(file_list)}")
+        logger.info(f"\n=== Processing date {date_str} ===")
+        logger.info(f"  Files: {len(file_list)}")
         for file in file_list:
-            print(f"    - {os.path.basename(file)}")
+            logger.info(f"    - {os.path.basename(file)}")
         
         # Get EDF reference times for all files in this date group
-        reference_times = get_edf_reference_times(file_list)
+        reference_times = get_edf_reference_times(file_list, edf_index)
         if not reference_times:
-            print(f"  Cannot find EDF reference times for files in date {date_str}")
+            logger.info(f"  Cannot find EDF reference times for files in date {date_str}")
             continue
         
-        print(f"  Found EDF references for {len(reference_times)} files")
+        logger.info(f"  Found EDF references for {len(reference_times)} files")
         
         # Process each file with its own EDF reference time
         success_count = 0
@@ -284,14 +382,15 @@ def main():
                 if process_excel_file(file_path, reference_times[file_path]):
                     success_count += 1
             else:
-                print(f"  Skipping {os.path.basename(file_path)} - no EDF reference time")
+                logger.info(f"  Skipping {os.path.basename(file_path)} - no EDF reference time")
             total_files += 1
         
         total_success += success_count
-        print(f"  Date {date_str} complete: {success_count}/{len(file_list)} success")
+        logger.info(f"  Date {date_str} complete: {success_count}/{len(file_list)} success")
     
-    print(f"\n=== Overall processing complete ===")
-    print(f"Total success: {total_success}/{total_files} files")
+    logger.info(f"\n=== Overall processing complete ===")
+    logger.info(f"Total success: {total_success}/{total_files} files")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
     main()
@@ -10,12 +10,13 @@ This script will:
 """
 
 import os
-import glob
+import sys
 from pathlib import Path
-import shutil
-import openpyxl
 import logging
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 def setup_logging():
     """Setup logging to both console and file"""
@@ -23,109 +24,99 @@ def setup_logging():
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     log_filename = f"log_rollback_{timestamp}.log"
     
-    # Configure logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_filename, encoding='utf-8'),
-            logging.StreamHandler()
-        ]
-    )
+    # Console shows plain messages; the log file gets timestamps
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter('%(message)s'))
+    file_handler = logging.FileHandler(log_filename, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[file_handler, console_handler])
     
     return log_filename
 
-def log_print(message):
-    """Print message to both console and log file"""
-    print(message)
-    logging.info(message)
+def find_files(match):
+    """Files below the current directory whose name satisfies match (hidden files and directories skipped)"""
+    paths = []
+    for root, dirs, files in os.walk('.'):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if not name.startswith('.') and match(name):
+                paths.append(os.path.normpath(os.path.join(root, name)))
+    return paths
+
+def rollback_excel_file(excel_file):
+    """Remove Column E from one Excel file; returns its log messages and whether it was changed"""
+    import openpyxl
+    
+    messages = [f"\nProcessing: {excel_file}"]
+    
+    try:
+        wb = openpyxl.load_workbook(excel_file)
+        ws = wb.active
+        
+        # Clear Column E in place in one pass, noting whether it held any relative time data
+        has_relative_time = False
+        for (cell,) in ws.iter_rows(min_col=5, max_col=5):
+            if cell.value is not None:
+                if str(cell.value).strip() != '':
+                    has_relative_time = True
+                cell.value = None
+        
+        if not has_relative_time:
+            messages.append("  - No relative time data found, skipping")
+            return messages, False
+        
+        # Save file
+        wb.save(excel_file)
+        messages.append(f"  ✓ Removed relative time data from Column E")
+        return messages, True
+        
+    except Exception as e:
+        messages.append(f"  ✗ Error processing {excel_file}: {e}")
+        return messages, False
 
 def rollback_excel_files():
     """Remove relative time data (Column E) from Excel files"""
-    log_print("\n=== Excel File Rollback ===")
+    logger.info("\n=== Excel File Rollback ===")
     
     # Find all Excel files
-    excel_files = glob.glob("**/*.xlsx", recursive=True)
-    excel_files = [f for f in excel_files if not os.path.basename(f).startswith('~$')]
+    excel_files = find_files(lambda name: name.endswith('.xlsx') and not name.startswith('~$'))
     
     if not excel_files:
-        log_print("No Excel files found.")
+        logger.info("No Excel files found.")
         return
     
-    log_print(f"Found {len(excel_files)} Excel files:")
+    logger.info(f"Found {len(excel_files)} Excel files:")
     for excel_file in excel_files:
-        log_print(f"  - {excel_file}")
+        logger.info(f"  - {excel_file}")
     
-    # Process each Excel file
+    # Process the Excel files in a thread pool (mostly file and zip I/O); each file's
+    # messages are printed together, in the original order
     processed_count = 0
     
-    for excel_file in excel_files:
-        log_print(f"\nProcessing: {excel_file}")
-        
-        try:
-            wb = openpyxl.load_workbook(excel_file)
-            ws = wb.active
-            
-            # Convert data to list
-            data = []
-            for row_num in range(1, ws.max_row + 1):
-                row_values = []
-                for col_num in range(1, ws.max_column + 1):
-                    cell_value = ws.cell(row=row_num, column=col_num).value
-                    row_values.append(cell_value)
-                data.append(row_values)
-            
-            # Check if Column E (index 4) exists and has data
-            has_relative_time = False
-            for i in range(len(data)):
-                if len(data[i]) > 4 and data[i][4] is not None and str(data[i][4]).strip() != '':
-                    has_relative_time = True
-                    break
-            
-            if not has_relative_time:
-                log_print("  - No relative time data found, skipping")
-                continue
-            
-            # Remove Column E (index 4) data
-            for i in range(len(data)):
-                if len(data[i]) > 4:
-                    data[i][4] = None  # Clear Column E
-            
-            # Create new workbook and save
-            new_wb = openpyxl.Workbook()
-            new_ws = new_wb.active
-            
-            # Write data to new worksheet (without Column E)
-            for i, row_data in enumerate(data):
-                for j, cell_value in enumerate(row_data):
-                    if cell_value is not None and j != 4:  # Skip Column E
-                        new_ws.cell(row=i+1, column=j+1, value=cell_value)
-            
-            # Save file
-            new_wb.save(excel_file)
-            log_print(f"  ✓ Removed relative time data from Column E")
-            processed_count += 1
-            
-        except Exception as e:
-            log_print(f"  ✗ Error processing {excel_file}: {e}")
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+        for messages, processed in executor.map(rollback_excel_file, excel_files):
+            for message in messages:
+                logger.info(message)
+            if processed:
+                processed_count += 1
     
-    log_print(f"\n=== Excel Rollback Complete ===")
-    log_print(f"Processed files: {processed_count}")
+    logger.info(f"\n=== Excel Rollback Complete ===")
+    logger.info(f"Processed files: {processed_count}")
 
 def rollback_edf_files():
     """Rollback EDF files to original state"""
-    log_print("=== EDF File Rollback ===")
+    logger.info("=== EDF File Rollback ===")
     
     # Find all _backup_*.edf files (new naming pattern)
-    backup_files = glob.glob("**/*_backup_*.edf", recursive=True)
+    backup_files = find_files(lambda name: name.endswith('.edf') and '_backup_' in name[:-4])
     
     if not backup_files:
-        log_print("No backup files found.")
+        logger.info("No backup files found.")
         return
     
-    log_print(f"Found {len(backup_files)} backup files:")
+    logger.info(f"Found {len(backup_files)} backup files:")
     for backup_file in backup_files:
-        log_print(f"  - {backup_file}")
+        logger.info(f"  - {backup_file}")
     
     # Process each backup file
     restored_count = 0
@@ -153,43 +144,43 @@ def rollback_edf_files():
         else:
             edfplus_path = None
         
-        log_print(f"\nProcessing: {backup_path.name}")
-        log_print(f"  Original: {original_name}")
+        logger.info(f"\nProcessing: {backup_path.name}")
+        logger.info(f"  Original: {original_name}")
         if edfplus_path:
-            log_print(f"  EDF+ file: {final_name}")
+            logger.info(f"  EDF+ file: {final_name}")
         
         try:
-            # Restore backup to original name
-            shutil.move(str(backup_path), str(original_path))
-            log_print(f"  ✓ Restored backup: {original_name}")
+            # Restore backup to original name (same directory, so one atomic rename)
+            os.replace(backup_path, original_path)
+            logger.info(f"  ✓ Restored backup: {original_name}")
             restored_count += 1
             
             # Remove the EDF+ file if it exists
             if edfplus_path and edfplus_path.exists():
                 edfplus_path.unlink()
-                log_print(f"  ✓ Removed EDF+ file: {final_name}")
+                logger.info(f"  ✓ Removed EDF+ file: {final_name}")
                 removed_edfplus_count += 1
             
         except Exception as e:
-            log_print(f"  ✗ Error processing {backup_path.name}: {e}")
+            logger.error(f"  ✗ Error processing {backup_path.name}: {e}")
     
-    log_print(f"\n=== Rollback Complete ===")
-    log_print(f"Restored files: {restored_count}")
-    log_print(f"Removed EDF+ files: {removed_edfplus_count}")
+    logger.info(f"\n=== Rollback Complete ===")
+    logger.info(f"Restored files: {restored_count}")
+    logger.info(f"Removed EDF+ files: {removed_edfplus_count}")
 
 def main():
     """Main function"""
     # Setup logging
     log_filename = setup_logging()
-    log_print("=== Rollback Started ===")
-    log_print(f"Log file: {log_filename}")
+    logger.info("=== Rollback Started ===")
+    logger.info(f"Log file: {log_filename}")
     
-    log_print("Starting complete rollback...")
+    logger.info("Starting complete rollback...")
     
     # Confirm before proceeding
     response = input("This will restore original EDF files, remove EDF+ files, and remove relative time data from Excel files. Continue? (y/N): ")
     if response.lower() != 'y':
-        log_print("Rollback cancelled.")
+        logger.info("Rollback cancelled.")
         return
     
     # Rollback EDF files
@@ -198,9 +189,9 @@ def main():
     # Rollback Excel files
     rollback_excel_files()
     
-    log_print("\n=== Complete Rollback Finished ===")
-    log_print("All changes have been reverted to original state.")
-    log_print(f"Log saved to: {log_filename}")
+    logger.info("\n=== Complete Rollback Finished ===")
+    logger.info("All changes have been reverted to original state.")
+    logger.info(f"Log saved to: {log_filename}")
 
 if __name__ == "__main__":
     main()